@@ -0,0 +1,33 @@
+# cython: language_level=3
+"""
+Optional compiled helpers for pichler module
+
+Build in place with `cythonize -i _pichler_fast.pyx`, pichler falls back to pure Python code if module isn't built.
+"""
+
+from cpython.list cimport PyList_New, PyList_SET_ITEM
+from cpython.ref cimport Py_INCREF
+
+def extract_values(list data):
+	"""
+	Pick raw values from data entries of RPC response
+	
+	Parameters
+	----------
+	data : list
+		List of response entries (dicts with `value` item)
+	
+	Returns
+	-------
+	list
+		Raw values in original order
+	"""
+	cdef Py_ssize_t i, n = len(data)
+	cdef list values = PyList_New(n)
+	cdef object value
+	for i in range(n):
+		value = (<dict?>data[i])['value']
+		# PyList_SET_ITEM steals reference
+		Py_INCREF(value)
+		PyList_SET_ITEM(values, i, value)
+	return values
@@ -8,8 +8,75 @@ https://downloads.nabto.com/assets/docs/TEN025 Writing a Nabto API client applic
 
 import sys
 import os
-import json
+import asyncio
 from ctypes import *
+try:
+	# orjson is optional, but considerably faster than json (and parses buffers without copying them)
+	from orjson import loads as json_loads
+except ImportError:
+	import json
+
+	def json_loads(data):
+		return json.loads(bytes(data))
+try:
+	import cffi
+except ImportError:
+	# cffi is optional, RPC calls fall back to ctypes
+	cffi = None
+
+# Prototypes of used Nabto client API functions (argument types, return type)
+_PROTOTYPES = {
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoStartup(const char* nabtoHomeDir);
+	'nabtoStartup': ([c_char_p], c_int),
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoShutdown(void);
+	'nabtoShutdown': ([], c_int),
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoInstallDefaultStaticResources(const char* resourceDir);
+	'nabtoInstallDefaultStaticResources': ([c_char_p], c_int),
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoSetOption(const char* name, const char* value);
+	'nabtoSetOption': ([c_char_p, c_char_p], c_int),
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoCreateProfile(const char* email, const char* password);
+	'nabtoCreateProfile': ([c_char_p, c_char_p], c_int),
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoOpenSession(nabto_handle_t* session, const char* id, const char* password);
+	'nabtoOpenSession': ([POINTER(c_void_p), c_char_p, c_char_p], c_int),
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoCloseSession(nabto_handle_t session);
+	'nabtoCloseSession': ([c_void_p], c_int),
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoGetLocalDevices(char*** devices, int* numberOfDevices);
+	'nabtoGetLocalDevices': ([POINTER(POINTER(c_char_p)), POINTER(c_int)], c_int),
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoRpcSetDefaultInterface(nabto_handle_t session, const char* interfaceDefinition, char** errorMessage);
+	'nabtoRpcSetDefaultInterface': ([c_void_p, c_char_p, POINTER(c_void_p)], c_int),
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoRpcInvoke(nabto_handle_t session, const char* nabtoUrl, char** jsonResponse);
+	# (returned strings are received as void* so they can be read in place and freed afterwards)
+	'nabtoRpcInvoke': ([c_void_p, c_char_p, POINTER(c_void_p)], c_int),
+	# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoFree(void* p);
+	'nabtoFree': ([c_void_p], c_int),
+}
+
+# Declarations for RPC calls made through cffi (when available)
+_CDEF = '''
+typedef void* nabto_handle_t;
+typedef int nabto_status_t;
+nabto_status_t nabtoRpcInvoke(nabto_handle_t session, const char* nabtoUrl, char** jsonResponse);
+nabto_status_t nabtoFree(void* p);
+'''
+
+# strlen() of C runtime, used to find size of responses returned by Nabto client
+_strlen = (cdll.msvcrt if sys.platform == 'win32' else CDLL(None)).strlen
+_strlen.argtypes = [c_void_p]
+_strlen.restype = c_size_t
+
+def _view(address):
+	return memoryview((c_char * _strlen(address)).from_address(address))
+
+class NabtoError(OSError):
+	"""
+	Error reported by Nabto client library (`errno` holds Nabto status)
+	"""
+
+	def __init__(self, status, function, message=None):
+		if message:
+			super().__init__(status, '%s failed: %s' % (function, message))
+		else:
+			super().__init__(status, '%s failed' % function)
 
 class Client:
 	"""
@@ -25,10 +92,26 @@ class Client:
 			library = 'libnabto_client_api.so'
 
 		package_dir = os.path.dirname(os.path.abspath(__file__))
-		self.client = cdll.LoadLibrary(os.path.join(package_dir, 'libs', library))
+		path = os.path.join(package_dir, 'libs', library)
+		self.client = cdll.LoadLibrary(path)
+
+		# cffi calls avoid libffi type construction of ctypes, so use them for RPC when possible
+		self.cffi = None
+		if cffi:
+			ffi = cffi.FFI()
+			ffi.cdef(_CDEF)
+			self.cffi = (ffi, ffi.dlopen(path))
+
+		# declare signatures once, so ctypes doesn't have to guess argument conversions on every call
+		for name, (argtypes, restype) in _PROTOTYPES.items():
+			function = getattr(self.client, name)
+			function.argtypes = argtypes
+			function.restype = restype
 
 		# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoStartup(const char* nabtoHomeDir);
-		self.client.nabtoStartup(home.encode())
+		status = self.client.nabtoStartup(home.encode())
+		if status != 0:
+			raise NabtoError(status, 'nabtoStartup')
 		self.client.nabtoInstallDefaultStaticResources(None)
 		self.client.nabtoSetOption(b'urlPortalHostName', b'lscontrol')
 
@@ -43,16 +126,24 @@ class Client:
 		Returns
 		-------
 		list
-			Found devices
+			IDs of found devices
 		"""
-		devices = pointer(c_char_p())
+		devices = POINTER(c_char_p)()
 		count = c_int(0)
-		# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoget_local_devices(char*** devices, int* numberOfDevices);
-		self.client.nabtoget_local_devices(pointer(devices), pointer(count))
-		if (count.value != 0):
-			return [devices.contents.value]
+		# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoGetLocalDevices(char*** devices, int* numberOfDevices);
+		status = self.client.nabtoGetLocalDevices(byref(devices), byref(count))
+		if status != 0:
+			raise NabtoError(status, 'nabtoGetLocalDevices')
+		if not devices:
+			return []
 
-		return []
+		# view returned array as a whole, names and the array itself have to be freed by caller
+		names = cast(devices, POINTER(c_void_p * count.value)).contents
+		result = [string_at(name).decode() for name in names]
+		for name in names:
+			self.client.nabtoFree(name)
+		self.client.nabtoFree(devices)
+		return result
 
 	def CreateProfile(self, user, pwd):
 		"""
@@ -89,32 +180,53 @@ class Client:
 		Client.Session
 			Session object
 		"""
-		return self.Session(self.client, user, pwd)
+		return self.Session(self.client, user, pwd, self.cffi)
 
 	class Session:
 		"""
 		A class that represents opened session
 		"""
-		def __init__(self, client, user, pwd):
+		def __init__(self, client, user, pwd, cffi=None):
 			self.client = client
+			self.session = None
 
+			user = user.encode()
+			pwd = pwd.encode()
 			session = c_void_p()
-			# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoopen_session(nabto_handle_t* session, const char* id, const char* password);
-			status = self.client.nabtoOpenSession(pointer(session), user.encode(), pwd.encode())
-			if status == 5:
-				status = self.client.nabtoCreateProfile(user.encode(), pwd.encode())
-				if status != 0:
-					print('nabtoCreateProfile error (%d)' % status)
+			for attempt in range(2):
+				# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoOpenSession(nabto_handle_t* session, const char* id, const char* password);
+				status = self.client.nabtoOpenSession(byref(session), user, pwd)
+				if status != 5 or attempt:
+					break
 
-				session = c_void_p()
-				status = self.client.nabtoOpenSession(pointer(session), user.encode(), pwd.encode())
+				# profile for given account doesn't exist yet, create it and try again
+				created = self.client.nabtoCreateProfile(user, pwd)
+				if created != 0:
+					raise NabtoError(created, 'nabtoCreateProfile')
 
 			if status != 0:
-				print('nabtoOpenSession error (%d)' % status)
+				raise NabtoError(status, 'nabtoOpenSession')
 			self.session = session
 
+			self._free = client.nabtoFree
+			if cffi:
+				self._ffi, self._lib = cffi
+				self._handle = self._ffi.cast('nabto_handle_t', session.value)
+				self._invoke = self._invoke_cffi
+			else:
+				self._rpc_invoke = client.nabtoRpcInvoke
+				self._invoke = self._invoke_ctypes
+
 		def __del__(self):
-			self.client.nabtoCloseSession(self.session)
+			self.close()
+
+		def close(self):
+			"""
+			Close session (if not closed already)
+			"""
+			if self.session is not None:
+				self.client.nabtoCloseSession(self.session)
+				self.session = None
 
 		def rpc_set_default_interface(self, interfaceDefinition):
 			"""
@@ -122,13 +234,16 @@ class Client:
 			
 			Parameters
 			----------
-			interfaceDefinition : str
+			interfaceDefinition : str or bytes
 				XML with RPC interface definition
 			"""
-			err = c_char_p()
+			if not isinstance(interfaceDefinition, bytes):
+				interfaceDefinition = interfaceDefinition.encode()
+			err = c_void_p()
 			# NABTO_DECL_PREFIX nabto_status_t NABTOAPI nabtoRpcSetDefaultInterface(nabto_handle_t session, const char* interfaceDefinition, char** errorMessage);
-			if self.client.nabtoRpcSetDefaultInterface(self.session, interfaceDefinition.encode(), pointer(err)) != 0:
-				print('nabtoRpcSetDefaultInterface error: %s' % err)
+			status = self.client.nabtoRpcSetDefaultInterface(self.session, interfaceDefinition, byref(err))
+			if status != 0:
+				raise NabtoError(status, 'nabtoRpcSetDefaultInterface', self._message(err.value))
 
 		def rpc_invoke(self, nabtoUrl):
 			"""
@@ -136,7 +251,56 @@ class Client:
 			
 			Parameters
 			----------
-			nabtoUrl : str
+			nabtoUrl : str or bytes
+				URL that contains RPC command along with command parameters
+			
+			Returns
+			-------
+			dict
+				RPC response
+
+			Raises
+			------
+			NabtoError
+				If RPC command failed
+			"""
+			return self.rpc_invoke_raw(nabtoUrl, json_loads)
+
+		def rpc_invoke_raw(self, nabtoUrl, parse=bytes):
+			"""
+			Invoke RPC command and return its response processed by given function
+			
+			Parameters
+			----------
+			nabtoUrl : str or bytes
+				URL that contains RPC command along with command parameters
+			parse : callable, optional
+				Function called with response (JSON) before it's released by Nabto client, by default bytes
+				(it gets a memoryview of client's buffer, so it must not keep reference to it)
+			
+			Returns
+			-------
+			object
+				Result of `parse` function
+
+			Raises
+			------
+			NabtoError
+				If RPC command failed
+			"""
+			if self.session is None:
+				raise ValueError('Session is closed')
+			if not isinstance(nabtoUrl, bytes):
+				nabtoUrl = nabtoUrl.encode()
+			return self._invoke(nabtoUrl, parse)
+
+		async def rpc_invoke_async(self, nabtoUrl):
+			"""
+			Invoke RPC command without blocking event loop (call runs in default executor)
+			
+			Parameters
+			----------
+			nabtoUrl : str or bytes
 				URL that contains RPC command along with command parameters
 			
 			Returns
@@ -144,12 +308,37 @@ class Client:
 			dict
 				RPC response
 			"""
-			out = c_char_p()
-			self.client.nabtoRpcInvoke(self.session, nabtoUrl.encode(), pointer(out))
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(None, self.rpc_invoke, nabtoUrl)
 
-			if out:
-				response = out.value
-				self.client.nabtoFree(out)
-				return json.loads(response)
+		def _message(self, address):
+			# error message returned by Nabto client (if any), released right away
+			if not address:
+				return None
+			try:
+				return string_at(address).decode(errors='replace')
+			finally:
+				self._free(address)
 
-			return []
+		def _invoke_ctypes(self, url, parse):
+			out = c_void_p()
+			status = self._rpc_invoke(self.session, url, byref(out))
+			if status != 0:
+				raise NabtoError(status, 'nabtoRpcInvoke', self._message(out.value))
+
+			try:
+				return parse(_view(out.value))
+			finally:
+				self._free(out)
+
+		def _invoke_cffi(self, url, parse):
+			out = self._ffi.new('char**')
+			status = self._lib.nabtoRpcInvoke(self._handle, url, out)
+			address = int(self._ffi.cast('uintptr_t', out[0]))
+			if status != 0:
+				raise NabtoError(status, 'nabtoRpcInvoke', self._message(address))
+
+			try:
+				return parse(_view(address))
+			finally:
+				self._lib.nabtoFree(out[0])
@@ -5,14 +5,84 @@ Module for accessing Pichler ventilation / heat-pump unit
 import sys
 import os
 import nabto
-import json
-from collections import namedtuple
+import asyncio
+import configparser
+import threading
+import functools
+import itertools
+import time
+import re
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
 try:
-	import configparser
-except:
-	# python2 compatibility
-	import ConfigParser
-	configparser = ConfigParser
+	# optional compiled helper (see `_pichler_fast.pyx`)
+	from _pichler_fast import extract_values
+except ImportError:
+	def extract_values(data):
+		return [i['value'] for i in data]
+
+# integer value in JSON response of single value read
+_SCALAR_VALUE = re.compile(rb'"value":\s*(-?\d+)\s*[,}]')
+
+def _parse_scalar(response):
+	# response of single value read is searched for the value directly, parsing whole JSON is the fallback
+	match = _SCALAR_VALUE.search(response)
+	if match:
+		return int(match.group(1))
+	return nabto.json_loads(response)['response']['data'][0]['value']
+
+def _list_entries(lst):
+	for i in lst:
+		# entry is either (address, object) pair or plain address
+		try:
+			address, obj = i
+		except TypeError:
+			address, obj = i, 0
+		yield b'{"address":%d,"obj":%d}' % (address, obj)
+
+def _entry_key(i):
+	# hashable form of list entry, (address, object) tuple or plain address
+	try:
+		address, obj = i
+	except TypeError:
+		return i
+	return (address, obj)
+
+def _list_params(lst):
+	# JSON request is written directly, without building dicts that would be thrown away right after serialization
+	return b'json={"request":{"list":[' + b','.join(_list_entries(lst)) + b']}}'
+
+# URL templates / parameters of commands used by Pichler
+_READ_URL = b'%s%s.json?address=%d&obj=%d&length=%d'
+_PING_PARAMS = b'ping=1885957735'
+
+@functools.lru_cache(maxsize=256)
+def _read_url(prefix, command, address, obj, length):
+	# URLs of value reads are kept ready for repeated (polling) reads
+	return _READ_URL % (prefix, command.encode(), address, obj, length)
+
+@functools.lru_cache(maxsize=None)
+def _load_config(path):
+	config = configparser.ConfigParser()
+	config.read(path)
+	return config
+
+@functools.lru_cache(maxsize=None)
+def _load_rpc_xml(path):
+	# kept encoded, so it can be passed to Nabto client as it is
+	with open(path, 'rb') as file:
+		return file.read()
+
+class _Lease:
+	# session kept by a thread, dropped along with thread's local data when thread ends
+	def __init__(self, pool, session):
+		self.pool = pool
+		self.session = session
+
+	def __del__(self):
+		# deque.append is atomic, no lock needed during thread teardown
+		self.pool.append(self.session)
 
 class Pichler:
 	"""
@@ -21,11 +91,11 @@ class Pichler:
 	It allows to read runtime parameters (datapoints) as well as to read/write unit's settings (setpoints).
 	"""
 	
-	def __init__(self, device=None, user=None, passwd=None):
+	def __init__(self, device=None, user=None, passwd=None, sessions=None):
 		"""
 		Initialize communication with Pichler unit.
 
-		Creates underlying Nabto communication client and establishes session to device.
+		Underlying Nabto communication client is created and sessions to device are established on demand.
 		
 		Parameters
 		----------
@@ -35,33 +105,153 @@ class Pichler:
 			Name of account that should be used to access unit's data, by default None
 		passwd : str, optional
 			Password for given account, by default None
+		sessions : int, optional
+			Maximum number of sessions opened to device for concurrent requests, by default None
 
-		If any of these parameters is not provided, value from `pichler.ini` file is used instead.
+		If any of these parameters is not provided, value from `pichler.ini` file is used instead
+		(up to 4 sessions are used if `sessions` is not configured either).
 		"""
 		package_dir = os.path.dirname(os.path.abspath(__file__))
 
-		if not device or not user or not passwd:
-			config = configparser.ConfigParser()
-			config.read(os.path.join(package_dir, 'pichler.ini'))
+		config = _load_config(os.path.join(package_dir, 'pichler.ini'))
 
-			if not device:
-				device = config.get('pichler', 'device')
-			if not user:
-				user = config.get('pichler', 'user')
-			if not passwd:
-				passwd = config.get('pichler', 'pass')
+		if not device:
+			device = config.get('pichler', 'device')
+		if not user:
+			user = config.get('pichler', 'user')
+		if not passwd:
+			passwd = config.get('pichler', 'pass')
+		if not sessions:
+			sessions = config.getint('pichler', 'sessions') if config.has_option('pichler', 'sessions') else 4
 
 		if not '.' in device:
 			device += '.remote.lscontrol.dk'
 
 		self.device = device
-		self.client = nabto.Client(os.path.join(package_dir, '.home'))
-		self.session = self.client.open_session(user, passwd)
+		self._url_prefix = ('nabto://%s/' % device).encode()
+		self._command_urls = {}
+
+		# Nabto client is started and sessions are opened on first use (up to given count),
+		# each thread keeps its session until it ends (then session returns to pool of free sessions)
+		self._client = None
+		self._client_lock = threading.Lock()
+		self._package_dir = package_dir
+		self._user = user
+		self._passwd = passwd
+		self._closed = False
+		self._local = threading.local()
+		self._pool = deque()
+		self._pool_size = sessions
+		self._pool_opened = 0
+		self._pool_cond = threading.Condition()
+		self._sessions = []
+		self._shared = itertools.count()
 
-		with open(os.path.join(package_dir, 'unabto_queries.xml'), 'r') as file:
-		    rpc_xml = file.read()
+		# recently read values: (command, address, obj, length) -> (read time, values)
+		self._cache = OrderedDict()
+		self._cache_size = 256
+		self._cache_lock = threading.Lock()
 
-		self.session.rpc_set_default_interface(rpc_xml)
+		# worker threads for running blocking RPC calls concurrently
+		self._executor = ThreadPoolExecutor(max_workers=sessions)
+
+	def __del__(self):
+		self.close()
+
+	def close(self):
+		"""
+		Close all sessions to device
+
+		Pichler can't be used for communication with device afterwards.
+		"""
+		executor = getattr(self, '_executor', None)
+		if executor:
+			executor.shutdown(wait=False)
+
+		cond = getattr(self, '_pool_cond', None)
+		if cond is None:
+			return
+
+		with cond:
+			self._closed = True
+			sessions = self._sessions
+			self._sessions = []
+			# leases of all threads are dropped, sessions they return go to discarded pool
+			self._local = threading.local()
+			self._pool = deque()
+			self._pool_opened = 0
+			cond.notify_all()
+
+		for session in sessions:
+			session.close()
+
+	@property
+	def client(self):
+		"""
+		Nabto communication client (started on first access)
+		"""
+		if self._client is None:
+			with self._client_lock:
+				if self._client is None:
+					self._client = nabto.Client(os.path.join(self._package_dir, '.home'))
+		return self._client
+
+	@property
+	def session(self):
+		"""
+		Nabto session used by calling thread (opened on first access)
+		"""
+		return self._acquire_session()
+
+	def _open_session(self):
+		session = self.client.open_session(self._user, self._passwd)
+		session.rpc_set_default_interface(_load_rpc_xml(os.path.join(self._package_dir, 'unabto_queries.xml')))
+		return session
+
+	def _acquire_session(self):
+		if self._closed:
+			raise ValueError('Pichler is closed')
+		lease = getattr(self._local, 'lease', None)
+		if lease is not None:
+			return lease.session
+
+		with self._pool_cond:
+			while True:
+				if self._closed:
+					raise ValueError('Pichler is closed')
+				if self._pool:
+					session = self._pool.popleft()
+					break
+				if self._pool_opened < self._pool_size:
+					self._pool_opened += 1
+					session = None
+					break
+				if self._sessions:
+					# all sessions are kept by other threads, share one of them (Nabto client is thread safe)
+					return self._sessions[next(self._shared) % len(self._sessions)]
+				# wait for first session being opened by other thread
+				self._pool_cond.wait()
+
+		if session is None:
+			try:
+				session = self._open_session()
+			except BaseException:
+				with self._pool_cond:
+					if not self._closed:
+						self._pool_opened -= 1
+					self._pool_cond.notify_all()
+				raise
+			with self._pool_cond:
+				closed = self._closed
+				if not closed:
+					self._sessions.append(session)
+					self._pool_cond.notify_all()
+			if closed:
+				session.close()
+				raise ValueError('Pichler is closed')
+
+		self._local.lease = _Lease(self._pool, session)
+		return session
 
 	def rpc_invoke(self, command, params):
 		"""
@@ -73,18 +263,69 @@ class Pichler:
 		----------
 		command : str
 			Command name
-		params : str
+		params : str or bytes
 			Request parameters (JSON)
 		
 		Returns
 		-------
 		dict
 			Response from device
+
+		Raises
+		------
+		nabto.NabtoError
+			If session couldn't be opened or RPC command failed
+		"""
+		return self._invoke_url(self._command_url(command, params))['response']
+
+	def _command_url(self, command, params):
+		url = self._command_urls.get(command)
+		if url is None:
+			url = self._command_urls[command] = self._url_prefix + ('%s.json?' % command).encode()
+		if not isinstance(params, bytes):
+			params = params.encode()
+		return url + params
+
+	def _invoke_url(self, url, parse=None):
+		session = self._acquire_session()
+		return session.rpc_invoke(url) if parse is None else session.rpc_invoke_raw(url, parse)
+
+	def _rpc_invoke_scalar(self, url):
+		# response is parsed right in Nabto client's buffer
+		return self._invoke_url(url, _parse_scalar)
+
+	def clear_cache(self):
+		"""
+		Drop all cached datapoint / setpoint values, so following reads go to device
 		"""
-		r = self.session.rpc_invoke('nabto://%s/%s.json?%s' % (self.device, command, params))
-		if r:
-			return r['response']
-		return []
+		with self._cache_lock:
+			self._cache.clear()
+
+	def _read_values(self, command, address, obj, length, ttl):
+		key = (command, address, obj, length)
+		now = time.monotonic()
+		if ttl > 0:
+			with self._cache_lock:
+				entry = self._cache.get(key)
+				if entry and now - entry[0] < ttl:
+					self._cache.move_to_end(key)
+					return list(entry[1])
+
+		url = _read_url(self._url_prefix, command, address, obj, length)
+		if length == 1:
+			values = [self._rpc_invoke_scalar(url)]
+		else:
+			values = extract_values(self._invoke_url(url)['response']['data'])
+
+		# fresh values are cached even if caller didn't want cached ones, so later reads don't get older values
+		with self._cache_lock:
+			entry = self._cache.get(key)
+			if entry is None or entry[0] <= now:
+				self._cache[key] = (now, tuple(values))
+				self._cache.move_to_end(key)
+				if len(self._cache) > self._cache_size:
+					self._cache.popitem(last=False)
+		return values
 
 	def ping(self):
 		"""
@@ -95,9 +336,9 @@ class Pichler:
 		dict
 			Device's response to ping
 		"""
-		return self.rpc_invoke('ping', 'ping=1885957735')
+		return self.rpc_invoke('ping', _PING_PARAMS)
 
-	def datapoint_read_values(self, address, obj, length):
+	def datapoint_read_values(self, address, obj, length, ttl=0.5):
 		"""
 		Read raw values from one or more (neighboring) datapoints
 		
@@ -109,18 +350,18 @@ class Pichler:
 			Object to read from
 		length : int
 			Number of subsequent datapoints to read
+		ttl : float, optional
+			Maximum age of cached values (in seconds) that can be returned instead of reading device, by default 0.5
+			(0 disables cache)
 		
 		Returns
 		-------
 		list
 			List of raw values read from given address
 		"""
-		response = self.rpc_invoke('datapointReadValue', 'address=%d&obj=%d&length=%d' % (address, obj, length))
-		if response:
-			return [i['value'] for i in response['data']]
-		return []
+		return self._read_values('datapointReadValue', address, obj, length, ttl)
 
-	def datapoint_read_value(self, address, obj=0):
+	def datapoint_read_value(self, address, obj=0, ttl=0.5):
 		"""
 		Read raw value from single datapoint
 		
@@ -130,13 +371,16 @@ class Pichler:
 			Address to read from
 		obj : int, optional
 			Object to read from, by default 0
+		ttl : float, optional
+			Maximum age of cached value (in seconds) that can be returned instead of reading device, by default 0.5
+			(0 disables cache)
 		
 		Returns
 		-------
 		int
 			Raw value read from given address
 		"""
-		return self.datapoint_read_values(address, obj, 1)[0]
+		return self.datapoint_read_values(address, obj, 1, ttl)[0]
 
 	def datapoint_read_list_values(self, lst):
 		"""
@@ -152,14 +396,9 @@ class Pichler:
 		list
 			Raw values for each pair in original order
 		"""
-		l = [{'address': i[0], 'obj': i[1]} if type(i) is tuple else {'address': i, 'obj': 0} for i in lst]
-		request = {'request': {'list': l}}
-		response = self.rpc_invoke('datapointReadListValue', 'json=%s' % json.dumps(request))
-		if response:
-			return [i['value'] for i in response['data']]
-		return []
+		return extract_values(self.rpc_invoke('datapointReadListValue', _list_params(lst))['data'])
 
-	def setpoint_read_values(self, address, obj, length):
+	def setpoint_read_values(self, address, obj, length, ttl=60):
 		"""
 		Read raw values from one or more (neighboring) setpoints
 		
@@ -171,18 +410,18 @@ class Pichler:
 			Object to read from
 		length : int
 			Number of subsequent setpoints to read
+		ttl : float, optional
+			Maximum age of cached values (in seconds) that can be returned instead of reading device, by default 60
+			(0 disables cache)
 		
 		Returns
 		-------
 		list
 			List of raw values read from given address
 		"""
-		response = self.rpc_invoke('setpointReadValue', 'address=%d&obj=%d&length=%d' % (address, obj, length))
-		if response:
-			return [i['value'] for i in response['data']]
-		return []
+		return self._read_values('setpointReadValue', address, obj, length, ttl)
 
-	def setpoint_read_value(self, address, obj=0):
+	def setpoint_read_value(self, address, obj=0, ttl=60):
 		"""
 		Read raw value from single setpoint
 		
@@ -192,13 +431,16 @@ class Pichler:
 			Address to read from
 		obj : int, optional
 			Object to read from, by default 0
+		ttl : float, optional
+			Maximum age of cached value (in seconds) that can be returned instead of reading device, by default 60
+			(0 disables cache)
 		
 		Returns
 		-------
 		int
 			Raw value read from given address
 		"""
-		return self.setpoint_read_values(address, obj, 1)[0]
+		return self.setpoint_read_values(address, obj, 1, ttl)[0]
 
 	def setpoint_read_list_values(self, lst):
 		"""
@@ -214,9 +456,130 @@ class Pichler:
 		list
 			Raw values for each pair in original order
 		"""
-		l = [{'address': i[0], 'obj': i[1]} if type(i) is tuple else {'address': i, 'obj': 0} for i in lst]
-		request = {'request': {'list': l}}
-		response = self.rpc_invoke('setpointReadListValue', 'json=%s' % json.dumps(request))
-		if response:
-			return [i['value'] for i in response['data']]
-		return []
+		return extract_values(self.rpc_invoke('setpointReadListValue', _list_params(lst))['data'])
+
+	def batch_read(self, datapoints=(), setpoints=()):
+		"""
+		Read raw values from multiple datapoints and setpoints at once
+
+		Each kind is read with a single RPC command regardless of number of entries
+		(RPC interface has no command that would read both kinds together).
+		
+		Parameters
+		----------
+		datapoints : list, optional
+			Datapoints to read (addresses or (address, object) pairs), by default none
+		setpoints : list, optional
+			Setpoints to read (addresses or (address, object) pairs), by default none
+		
+		Returns
+		-------
+		tuple
+			Pair of dicts (datapoints, setpoints) mapping each given entry to its raw value
+			(pairs given as lists or other sequences are keyed as (address, object) tuples)
+		"""
+		datapoints = [_entry_key(i) for i in datapoints]
+		setpoints = [_entry_key(i) for i in setpoints]
+		if datapoints and setpoints:
+			# both kinds needed, read setpoints in parallel to datapoints
+			future = self._executor.submit(self.setpoint_read_list_values, setpoints)
+			datapoint_values = self.datapoint_read_list_values(datapoints)
+			setpoint_values = future.result()
+		else:
+			datapoint_values = self.datapoint_read_list_values(datapoints) if datapoints else []
+			setpoint_values = self.setpoint_read_list_values(setpoints) if setpoints else []
+		return dict(zip(datapoints, datapoint_values)), dict(zip(setpoints, setpoint_values))
+
+	def batch(self):
+		"""
+		Create batch that collects datapoints and setpoints to be read together
+		
+		Usage::
+
+			with device.batch() as b:
+				b.datapoint(59)
+				b.setpoint(1, 2)
+			level = b.datapoints[59]
+
+		Returns
+		-------
+		Batch
+			Batch that reads all collected values when leaving `with` block
+		"""
+		return Batch(self)
+
+	async def _run_async(self, method, *args):
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(self._executor, method, *args)
+
+	async def datapoint_read_value_async(self, address, obj=0, ttl=0.5):
+		"""
+		Coroutine version of `datapoint_read_value`, RPC call runs in worker thread
+		"""
+		return await self._run_async(self.datapoint_read_value, address, obj, ttl)
+
+	async def datapoint_read_list_values_async(self, lst):
+		"""
+		Coroutine version of `datapoint_read_list_values`, RPC call runs in worker thread
+		"""
+		return await self._run_async(self.datapoint_read_list_values, lst)
+
+	async def setpoint_read_value_async(self, address, obj=0, ttl=60):
+		"""
+		Coroutine version of `setpoint_read_value`, RPC call runs in worker thread
+		"""
+		return await self._run_async(self.setpoint_read_value, address, obj, ttl)
+
+	async def setpoint_read_list_values_async(self, lst):
+		"""
+		Coroutine version of `setpoint_read_list_values`, RPC call runs in worker thread
+		"""
+		return await self._run_async(self.setpoint_read_list_values, lst)
+
+class Batch:
+	"""
+	A class that collects datapoints and setpoints and reads them with `Pichler.batch_read`.
+
+	Read values are available in `datapoints` and `setpoints` dicts after leaving `with` block,
+	keyed by address (or (address, object) pair if object was given).
+	"""
+
+	def __init__(self, device):
+		self.device = device
+		self.datapoints = {}
+		self.setpoints = {}
+		self._datapoints = []
+		self._setpoints = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.datapoints, self.setpoints = self.device.batch_read(self._datapoints, self._setpoints)
+
+	def datapoint(self, address, obj=None):
+		"""
+		Add datapoint to batch
+		
+		Parameters
+		----------
+		address : int
+			Address to read from
+		obj : int, optional
+			Object to read from, by default 0
+		"""
+		self._datapoints.append(address if obj is None else (address, obj))
+
+	def setpoint(self, address, obj=None):
+		"""
+		Add setpoint to batch
+		
+		Parameters
+		----------
+		address : int
+			Address to read from
+		obj : int, optional
+			Object to read from, by default 0
+		"""
+		self._setpoints.append(address if obj is None else (address, obj))